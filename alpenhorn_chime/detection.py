@@ -9,10 +9,12 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 
 import re
+import logging
 import pathlib
 import datetime
 import peewee as pw
-from functools import partial
+from time import monotonic
+from dataclasses import dataclass
 
 from alpenhorn.db import ArchiveAcq as AlpenAcq
 from alpenhorn.db import ArchiveFile as AlpenFile
@@ -20,25 +22,261 @@ from alpenhorn.db import ArchiveFile as AlpenFile
 import chimedb.core as db
 
 from chimedb.data_index.orm import (
+    AcqFileTypes,
     AcqType,
     ArchiveAcq,
     ArchiveFile,
     ArchiveInst,
+    FileType,
 )
 
+from . import info
+
 if TYPE_CHECKING:
     from collections.abc import Callable
 
     from alpenhorn.archive import ArchiveFileCopy
     from alpenhorn.update import UpdateableNode
 
+log = logging.getLogger(__name__)
+
+# A CHIME acquisition name
+_ACQ_RE = re.compile(r"^(\d{8}T\d{6}Z)_([^_]+)_([^_]+)\Z")
+
+# Pattern features which prevent a FileType pattern from being combined
+# with others into a single alternation: global inline flags (anywhere in
+# the pattern, which Python < 3.11 allows, applying them to the whole
+# regex) and numbered group references.
+_UNCOMBINABLE_RE = re.compile(r"\(\?[aiLmsux]+\)|\\[1-9]|\(\?\(\d")
+
+# The AcqType, ArchiveInst and FileType tables are small and rarely change,
+# so they're cached here instead of being queried for every import:
+#
+# * _acqtype_cache and _inst_cache map names to AcqTypes and ArchiveInsts.
+# * _filetype_cache maps AcqType ids to a (combined pattern, filetypes) pair.
+#   filetypes is a list of (compiled pattern, FileType) pairs for all the file
+#   types of that acquisition type having a pattern, and the combined pattern
+#   is all of those patterns joined into a single regex (see
+#   _combine_patterns), or None, if they couldn't be combined.
+#
+# The caches are re-read from the database after _CACHE_LIFETIME seconds.
+# They are also re-read early when a lookup misses (see _load_caches), so
+# a running daemon notices new types or instruments straight away, but not
+# more often than every _MISS_RELOAD_INTERVAL seconds.
+_CACHE_LIFETIME = 600
+_MISS_RELOAD_INTERVAL = 10
+_acqtype_cache: dict[str, AcqType] = dict()
+_inst_cache: dict[str, ArchiveInst] = dict()
+_filetype_cache: dict[
+    int, tuple[re.Pattern | None, list[tuple[re.Pattern, FileType]]]
+] = dict()
+_cache_expiry = 0.0
+_cache_loaded = 0.0
+
+# The (FileType id, pattern) pairs already reported as not compiling, so
+# that cache reloads don't repeat the error.
+_bad_patterns: set[tuple[int, str]] = set()
+
+
+def _combine_patterns(patterns: list[re.Pattern]) -> re.Pattern | None:
+    """Combine `patterns` into a single regex.
+
+    The result is the alternation of all the `patterns`, with the i-th
+    pattern wrapped in a group named "_ft<i>".  Named groups in the i-th
+    pattern are renamed by prefixing them with "_ft<i>_".  Matching the
+    result is equivalent to matching each pattern in turn and stopping at
+    the first match.
+
+    Parameters
+    ----------
+    patterns : list of re.Pattern
+        The patterns to combine
+
+    Returns
+    -------
+    combined : re.Pattern or None
+        The combined pattern, or None, if the patterns can't be combined.
+    """
+    parts = list()
+    expected_groups = set()
+    for index, pattern in enumerate(patterns):
+        text = pattern.pattern
+        if _UNCOMBINABLE_RE.search(text):
+            return None
+
+        prefix = f"_ft{index}"
+        expected_groups.add(prefix)
+        for name in pattern.groupindex:
+            new_name = f"{prefix}_{name}"
+            expected_groups.add(new_name)
+            text = (
+                text.replace(f"(?P<{name}>", f"(?P<{new_name}>")
+                .replace(f"(?P={name})", f"(?P={new_name})")
+                .replace(f"(?({name})", f"(?({new_name})")
+            )
+        parts.append(f"(?P<{prefix}>{text})")
+
+    try:
+        combined = re.compile("|".join(parts))
+    except re.error:
+        return None
+
+    # Make sure the renaming didn't go astray
+    if set(combined.groupindex) != expected_groups or combined.groups != sum(
+        pattern.groups + 1 for pattern in patterns
+    ):
+        return None
+
+    return combined
+
+
+def _match_filetype(acqtype: AcqType, file_name: str) -> (FileType, dict) | None:
+    """Determine the file type of a file.
+
+    Parameters
+    ----------
+    acqtype : AcqType
+        The acquisition type of the acquisition containing the file
+    file_name : str
+        The name of the file
+
+    Returns
+    -------
+    filetype : FileType
+        The detected file type
+    name_data : dict
+        The named subgroups of the file type pattern match.  May be empty.
+
+    If detection fails, None is returned instead.
+    """
+    try:
+        combined, filetypes = _filetype_cache[acqtype.id]
+    except KeyError:
+        return None
+
+    # If the patterns couldn't be combined, try them one at a time
+    if combined is None:
+        for pattern, filetype in filetypes:
+            m = pattern.match(file_name)
+            if m is not None:
+                return filetype, m.groupdict()
+        return None
+
+    m = combined.match(file_name)
+    if m is None:
+        return None
+
+    # The outermost group of the matching alternative is the last one
+    # closed, so it's always the lastgroup.
+    pattern, filetype = filetypes[int(m.lastgroup[3:])]
+    prefix = m.lastgroup + "_"
+    return filetype, {name: m.group(prefix + name) for name in pattern.groupindex}
+
+
+@dataclass(slots=True)
+class AcqData:
+    """The result of parsing a CHIME acquisition name.
+
+    Attributes
+    ----------
+    acqtime : datetime.datetime
+        the parsed acquisition datetime
+    acqinst : ArchiveInst
+        the ArchiveInst of this acquisition
+    acqtype : AcqType
+        the AcqType of this acquisition
+    """
+
+    acqtime: datetime.datetime
+    acqinst: ArchiveInst
+    acqtype: AcqType
+
+
+def clear_caches() -> None:
+    """Discard all cached database data.
+
+    The caches will be re-populated from the database the next
+    time they're needed.
+    """
+    global _cache_expiry
+
+    _cache_expiry = 0.0
+
+
+def _load_caches(miss: bool = False) -> bool:
+    """Populate the AcqType, ArchiveInst and FileType caches, if necessary.
+
+    Nothing happens if the caches are already loaded and have
+    not yet expired.
+
+    Parameters
+    ----------
+    miss : bool, optional
+        Set this after a cache lookup has failed.  In that case, the
+        caches are re-loaded even if they haven't expired, as long as
+        they were last loaded at least _MISS_RELOAD_INTERVAL seconds ago.
+
+    Returns
+    -------
+    loaded : bool
+        True if the caches were (re-)loaded by this call.
+    """
+    global _acqtype_cache, _inst_cache, _filetype_cache, _cache_expiry
+    global _cache_loaded
+
+    now = monotonic()
+    if now < _cache_expiry and not (
+        miss and now >= _cache_loaded + _MISS_RELOAD_INTERVAL
+    ):
+        return False
+
+    # New dicts are created and then swapped in, so concurrent
+    # readers never see a partially-populated cache.
+    _acqtype_cache = {acqtype.name: acqtype for acqtype in AcqType.select()}
+    _inst_cache = {inst.name: inst for inst in ArchiveInst.select()}
+
+    filetypes = dict()
+    compiled = dict()
+    for link in (
+        AcqFileTypes.select(AcqFileTypes, FileType)
+        .join(FileType)
+        .where(FileType.pattern.is_null(False))
+    ):
+        # Each FileType's pattern is compiled once, even if it's used by
+        # several AcqTypes.  A bad pattern only disables its own FileType.
+        filetype = link.file_type
+        if filetype.id not in compiled:
+            try:
+                compiled[filetype.id] = re.compile(filetype.pattern)
+            except re.error as e:
+                # Only complain loudly the first time
+                key = (filetype.id, filetype.pattern)
+                log.log(
+                    logging.DEBUG if key in _bad_patterns else logging.ERROR,
+                    f"Ignoring FileType {filetype.name}: "
+                    f"bad pattern {filetype.pattern!r}: {e}",
+                )
+                _bad_patterns.add(key)
+                compiled[filetype.id] = None
+        pattern = compiled[filetype.id]
+        if pattern is not None:
+            filetypes.setdefault(link.acq_type_id, list()).append((pattern, filetype))
+    _filetype_cache = {
+        acqtype_id: (_combine_patterns([pattern for pattern, _ in pairs]), pairs)
+        for acqtype_id, pairs in filetypes.items()
+    }
+
+    _cache_expiry = now + _CACHE_LIFETIME
+    _cache_loaded = now
+    return True
+
 
 def set_info(
     info_name: str | None,
     node: UpdateableNode,
     path: pathlib.Path,
     item: ArchiveAcq | ArchiveFile,
-    name_data: dict = dict(),
+    name_data: dict | None = None,
 ) -> None:
     """Populate Acq or File Info class, if necessary.
 
@@ -47,7 +285,7 @@ def set_info(
     Parameters
     ----------
     info_name : str or None
-        The name of the Info class in `alpenhorn_chime.info`.
+        The name of the Info class in `alpenhorn_chime.info.INFO_CLASSES`.
     node : UpdateableNode
         The node on which the import has happened
     path : pathlib.Path
@@ -56,26 +294,55 @@ def set_info(
         The archive item (acq or file) that we're adding info for
     name_data : dict, optional
         A dictionary containing all the named subgroups of the pathname
-        pattern match.  May be empty.
+        pattern match.  May be empty.  If omitted, an empty dict is used.
     """
-    from . import info
-
     # Do nothing if there's no info class
     if info_name is None:
         return
 
-    class_ = getattr(info, info_name)
+    if name_data is None:
+        name_data = dict()
+
+    is_func, class_ = info.INFO_CLASSES[info_name]
 
     # If class_ is _not_ a class, then we it's a function that will
     # return us the class when passed the archive item.
-    if not isinstance(class_, type):
+    if is_func:
         class_ = class_(item)
 
     # Generate the new row by passing a bunch of stuff to the
     # class constructor, which will replace it with normal
     # table data before the peewee Model is instantiated
-    info = class_(item_=item, node_=node, path_=path, name_data_=name_data)
-    info.save()
+    row = class_(item_=item, node_=node, path_=path, name_data_=name_data)
+    row.save()
+
+
+def _try_set_info(info_name: str | None, **kwargs) -> Exception | None:
+    """Call `set_info` in a savepoint.
+
+    If `set_info` fails, only the savepoint is rolled back, and the
+    exception is returned rather than raised, so the caller can still
+    commit the rest of its transaction before reporting it.
+
+    Parameters
+    ----------
+    info_name : str or None
+        Passed to `set_info`.
+    **kwargs
+        The other arguments to `set_info`.
+
+    Returns
+    -------
+    error : Exception or None
+        The exception raised by `set_info`, or None, if it succeeded.
+    """
+    try:
+        with ArchiveAcq._meta.database.atomic():
+            set_info(info_name, **kwargs)
+    except Exception as e:
+        return e
+
+    return None
 
 
 def store_info(
@@ -103,46 +370,113 @@ def store_info(
         The node on which the import happened
     import_data : dict
         The import data collected by `import_detect`.  Filled in by that
-        function via a `functools.partial` before this function is given to
+        function via a `StoreInfoCallback` before this function is given to
         alpenhornd.
     """
 
+    # Each item (the acq, then the file) is updated in its own transaction.
+    # Its info record is made in a savepoint, so if the info class fails
+    # (say, on an unreadable file), the type is still recorded.  Failures
+    # are only raised once both items are done, because alpenhorn only
+    # gives us each item on the import that creates it.
+    database = ArchiveAcq._meta.database
+    acq_error = None
+    file_error = None
+
     # Add extra acq data, if necessary
     if acq is not None:
-        # Our ArchiveAcq is not Alpenhorn's ArchiveAcq
-        acq = ArchiveAcq.get(id=acq.id)
-        acq.type = import_data["acqtype"]
-        acq.inst = import_data["acqinst"]
-        acq.save()
-
-        # If there's an AcqInfo class, create a new record
-        set_info(
-            import_data["acqtype"].info_class,
-            node=node,
-            path=copy.file.path,
-            item=acq,
-            name_data={"acqtime": import_data["acqtime"]},
-        )
+        with database.atomic():
+            ArchiveAcq.update(
+                type=import_data["acqtype"], inst=import_data["acqinst"]
+            ).where(ArchiveAcq.id == acq.id).execute()
+
+            # Our ArchiveAcq is not Alpenhorn's ArchiveAcq.  Rather than
+            # re-fetching the row we just updated, re-wrap the data we have.
+            acq = ArchiveAcq(**acq.__data__)
+            acq.type = import_data["acqtype"]
+            acq.inst = import_data["acqinst"]
+
+            # If there's an AcqInfo class, create a new record
+            acq_error = _try_set_info(
+                import_data["acqtype"].info_class,
+                node=node,
+                path=copy.file.path,
+                item=acq,
+                name_data={"acqtime": import_data["acqtime"]},
+            )
 
     # Add extra file data, if necessary
     if file is not None:
-        # Our ArchiveFile is not Alpenhorn's ArchiveFile
-        file = ArchiveFile.get(id=file.id)
-        file.type = import_data["filetype"]
-        file.save()
-
-        set_info(
-            import_data["filetype"].info_class,
-            node=node,
-            path=pathlib.PurePath(file.acq.name, file.name),
-            item=file,
-            name_data=import_data["name_data"],
-        )
+        with database.atomic():
+            ArchiveFile.update(type=import_data["filetype"]).where(
+                ArchiveFile.id == file.id
+            ).execute()
+
+            # Our ArchiveFile is not Alpenhorn's ArchiveFile.  As with the
+            # acq, re-wrap the data we already have.
+            file = ArchiveFile(**file.__data__)
+            file.type = import_data["filetype"]
+
+            # If we've just created the acq, use it, to save looking it up.
+            # Otherwise, fetch it together with its AcqType, so the info
+            # class can get at both without further queries.
+            if acq is not None:
+                file.acq = acq
+            else:
+                file.acq = (
+                    ArchiveAcq.select(ArchiveAcq, AcqType)
+                    .join(AcqType, pw.JOIN.LEFT_OUTER)
+                    .where(ArchiveAcq.id == file.acq_id)
+                    .get()
+                )
+
+            file_error = _try_set_info(
+                import_data["filetype"].info_class,
+                node=node,
+                path=pathlib.PurePath(file.acq.name, file.name),
+                item=file,
+                name_data=import_data["name_data"],
+            )
+
+    # Now that everything's committed, report any failure.  If both info
+    # classes failed, the file's error is logged and the acq's is raised.
+    if acq_error is not None:
+        if file_error is not None:
+            log.error(f"Unable to store info for file {file.name}", exc_info=file_error)
+        raise acq_error
+    if file_error is not None:
+        raise file_error
+
+
+class StoreInfoCallback:
+    """The callback returned by `import_detect`.
+
+    Calling this calls `store_info` with the stored `import_data`.
+    This is equivalent to `functools.partial(store_info, import_data=...)`,
+    but cheaper to create.
+
+    Parameters
+    ----------
+    import_data : dict
+        The import data collected by `import_detect`.
+    """
 
+    __slots__ = ("import_data",)
 
-def parse_acq(
-    name: str,
-) -> (datetime.datetime | None, ArchiveInst | None, AcqType | None):
+    def __init__(self, import_data: dict) -> None:
+        self.import_data = import_data
+
+    def __call__(
+        self,
+        copy: ArchiveFileCopy,
+        file: AlpenFile | None,
+        acq: AlpenAcq | None,
+        node: UpdateableNode,
+    ) -> None:
+        store_info(copy, file, acq, node, import_data=self.import_data)
+
+
+def parse_acq(name: str) -> AcqData | None:
     """Parse a CHIME acquisition name
 
     A standard CHIME acqusition name has the form:
@@ -158,45 +492,53 @@ def parse_acq(
 
     Returns
     -------
-    acq_data : dict or None
-        If parsing succeeds, returns a dict with three keys:
-          * acqtime: the parsed acquisition datetime
-          * acqinst: the ArchiveInst of this acquisition
-          * acqtype: the AcqType of this acqusition
-        On failure, None is returned
+    acq_data : AcqData or None
+        If parsing succeeds, returns the parsed acquisition time,
+        ArchiveInst and AcqType.  On failure, None is returned
     """
 
-    # Split the path on underscores
-    parts = str(name).split("_")
-
-    # If we don't have three parts, the path is invalid
-    if len(parts) != 3:
+    # Check the overall structure of the name
+    m = _ACQ_RE.match(name)
+    if m is None:
         return None
+    timestamp, inst_name, type_name = m.groups()
 
-    # Check that the third part is a known AcqType
+    # Check that the first part is a valid date.  The regex has already
+    # ensured the timestamp has the form YYYYMMDDTHHMMSSZ.  This is done
+    # before the type and instrument checks because it never needs the
+    # database, whereas those may need to (re-)load the caches.
     try:
-        acqtype = AcqType.get(name=parts[2])
-    except pw.DoesNotExist:
+        time = datetime.datetime(
+            int(timestamp[0:4]),
+            int(timestamp[4:6]),
+            int(timestamp[6:8]),
+            int(timestamp[9:11]),
+            int(timestamp[11:13]),
+            int(timestamp[13:15]),
+        )
+    except ValueError:
         return None
 
-    import logging
+    _load_caches()
+    acqtype = _acqtype_cache.get(type_name)
+    inst = _inst_cache.get(inst_name)
 
-    logging.getLogger(__name__).info(f"AT: {acqtype!r}")
+    # If either lookup failed, the type or instrument may have been
+    # added since the caches were loaded, so try re-loading them.
+    if (acqtype is None or inst is None) and _load_caches(miss=True):
+        acqtype = _acqtype_cache.get(type_name)
+        inst = _inst_cache.get(inst_name)
 
-    # Check that the second part is a known ArchiveInst
-    try:
-        inst = ArchiveInst.get(name=parts[1])
-    except pw.DoesNotExist:
+    # Check that the third part is a known AcqType
+    if acqtype is None:
         return None
 
-    # Check that the first part is a valid date
-    try:
-        time = datetime.datetime.strptime(parts[0], "%Y%m%dT%H%M%SZ")
-    except ValueError:
+    # Check that the second part is a known ArchiveInst
+    if inst is None:
         return None
 
     # Otherwise type detection succeeds
-    return {"acqtime": time, "acqinst": inst, "acqtype": acqtype}
+    return AcqData(acqtime=time, acqinst=inst, acqtype=acqtype)
 
 
 def import_detect(
@@ -220,7 +562,7 @@ def import_detect(
         When detection succeeds, this is the name of the
         acquisition.  On failure, this is None.
     callback : callable or None
-       When detection succeeds, this is a `functools.partial`
+       When detection succeeds, this is a `StoreInfoCallback`
        wrapping `store_info`.  On failure, this is None.
     """
 
@@ -228,34 +570,39 @@ def import_detect(
     db.connect(read_write=True)
 
     # Split the filename from the directory
-    acq_name = str(path.parent)
-    file_name = str(path.name)
+    acq_name = path.parent.as_posix()
+    file_name = path.name
 
     # Try to match the acq_name
-    import_data = parse_acq(acq_name)
+    acq_data = parse_acq(acq_name)
 
     # Did acq detection fail?
-    if import_data is None:
+    if acq_data is None:
         return None, None
 
-    # Try to determine the file type
-    for filetype in import_data["acqtype"].file_types:
-        if filetype.pattern is not None:
-            m = re.match(filetype.pattern, file_name)
-            if m is not None:
-                break
-    else:
-        # file detection failed
-        return None, None
+    # Try to determine the file type.  As with the acq, if that fails,
+    # the file type may be new, so re-load the caches and try again.
+    match = _match_filetype(acq_data.acqtype, file_name)
+    if match is None and _load_caches(miss=True):
+        match = _match_filetype(acq_data.acqtype, file_name)
 
-    # Remember filetype
-    import_data["filetype"] = filetype
-
-    # Regex group matches, if any.  This a tuple which may be empty.
-    import_data["name_data"] = m.groupdict()
+    # Did file detection fail?
+    if match is None:
+        return None, None
 
-    # Create partial for callback
-    callback = partial(store_info, import_data=import_data)
+    # Collect the import data.  The regex group matches in name_data
+    # are a dict which may be empty.
+    filetype, name_data = match
+    import_data = {
+        "acqtime": acq_data.acqtime,
+        "acqinst": acq_data.acqinst,
+        "acqtype": acq_data.acqtype,
+        "filetype": filetype,
+        "name_data": name_data,
+    }
+
+    # Create the callback
+    callback = StoreInfoCallback(import_data)
 
     # Success
     return acq_name, callback
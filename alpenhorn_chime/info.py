@@ -1,5 +1,8 @@
 """CHIME info classes."""
 
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
 from chimedb.data_index.orm import (
     ArchiveFile,
     CalibrationFileInfo,
@@ -15,6 +18,17 @@ from chimedb.data_index.orm import (
     WeatherFileInfo,
 )
 
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+
+# Calibration file info classes, keyed by AcqType name
+_CAL_INFO_CLASSES = {
+    "digitalgain": DigitalGainFileInfo,
+    "gain": CalibrationGainFileInfo,
+    "flaginput": FlagInputFileInfo,
+}
+
 
 # This is the indirect file class function for "calibration" files
 def cal_info_class(file: ArchiveFile) -> type[CalibrationFileInfo]:
@@ -24,6 +38,10 @@ def cal_info_class(file: ArchiveFile) -> type[CalibrationFileInfo]:
     shouldn't and there should probably just be a single one,
     because they're all the same anyways.
 
+    This needs `file.acq.type`.  To avoid two lazy foreign-key queries
+    per file, callers should pass a `file` whose acq and acq type have
+    already been populated, as `detection.store_info` does.
+
     Parameters
     ----------
     file : ArchiveFile
@@ -32,10 +50,31 @@ def cal_info_class(file: ArchiveFile) -> type[CalibrationFileInfo]:
 
     acqtype_name = file.acq.type.name
 
-    if acqtype_name == "digitalgain":
-        return DigitalGainFileInfo
-    if acqtype_name == "gain":
-        return CalibrationGainFileInfo
-    if acqtype_name == "flaginput":
-        return FlagInputFileInfo
-    raise ValueError(f'unknown acqtype: {acqtype_name}"')
+    class_ = _CAL_INFO_CLASSES.get(acqtype_name)
+    if class_ is None:
+        raise ValueError(f"unknown acqtype: {acqtype_name}")
+    return class_
+
+
+# The info classes, keyed by the name used for them in the info_class
+# column of the AcqType and FileType tables.  Each value is a tuple
+# (is_func, obj).  If is_func is False, obj is the info class itself.
+# Otherwise, obj is a function which returns the info class when passed
+# the archive item.
+INFO_CLASSES: dict[str, tuple[bool, type | Callable]] = {
+    class_.__name__: (False, class_)
+    for class_ in (
+        CalibrationFileInfo,
+        CalibrationGainFileInfo,
+        CorrAcqInfo,
+        CorrFileInfo,
+        DigitalGainFileInfo,
+        FlagInputFileInfo,
+        HFBAcqInfo,
+        HFBFileInfo,
+        RawadcAcqInfo,
+        RawadcFileInfo,
+        WeatherFileInfo,
+    )
+}
+INFO_CLASSES["cal_info_class"] = (True, cal_info_class)
@@ -1,10 +1,15 @@
 """Common fixtures."""
 
+import os
 import pytest
+import pathlib
+import tempfile
+import peewee as pw
 import chimedb.core as db
 import alpenhorn.db as adb
 from alpenhorn.db import ArchiveFileCopy, ArchiveFileCopyRequest
 from alpenhorn.db import StorageNode, StorageGroup, StorageTransferAction
+from unittest.mock import patch
 
 from chimedb.data_index.orm import (
     AcqFileTypes,
@@ -26,14 +31,61 @@ from chimedb.data_index.orm import (
 )
 
 
-@pytest.fixture
-def proxy():
+@pytest.fixture(scope="session")
+def testdata():
+    """Yields the path to the testdata directory."""
+
+    return str(pathlib.Path(__file__).with_name("testdata"))
+
+
+@pytest.fixture(scope="session")
+def tempdb():
+    """Create the test database.
+
+    Yields the path to the database.
+
+    The database is deleted at the end of the test session."""
+
+    # The database has to be a file, because alpenhornd runs in a separate
+    # process, but if there's a RAM-backed tmpfs available, put it there.
+    tmpdir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+    with tempfile.NamedTemporaryFile(suffix=".sql", dir=tmpdir) as sqldb:
+        yield sqldb.name
+
+
+@pytest.fixture(scope="session")
+def set_env(testdata, tempdb):
+    """Set up the environment for the tests."""
+
+    # We set both CHIMEDB vars, because while the test itself runs in test-safe mode,
+    # alpenhorn itself won't be doing that.
+    with patch.dict(
+        "os.environ",
+        ALPENHORN_CONFIG_FILE=str(pathlib.Path(testdata, "alpenhorn.yaml")),
+        CHIMEDB_SQLITE=tempdb,
+        CHIMEDB_TEST_SQLITE=tempdb,
+    ):
+        yield
+
+
+@pytest.fixture(scope="session")
+def proxy(set_env):
     """Open a connection to the database.
 
-    Returns the database proxy.
+    Returns the database proxy.  The connection is shared by the whole
+    test session.  It depends on `set_env`, so that it's always made to
+    the test database.
     """
     db.test_enable()
     db.connect(read_write=True)
+
+    # The test database is throw-away, so don't wait for fsyncs and
+    # keep the rollback journal in memory
+    if isinstance(db.proxy.obj, pw.SqliteDatabase):
+        db.proxy.obj.execute_sql("PRAGMA synchronous = OFF")
+        db.proxy.obj.execute_sql("PRAGMA journal_mode = MEMORY")
+
     adb.database_proxy.initialize(db.proxy.obj)
     adb.EnumField.native = False
     yield db.proxy
@@ -41,32 +93,33 @@ def proxy():
     db.close()
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def tables(proxy):
     """Ensure all the tables are created."""
 
-    proxy.create_tables(
-        [
-            AcqFileTypes,
-            AcqType,
-            ArchiveAcq,
-            ArchiveFile,
-            ArchiveFileCopy,
-            ArchiveFileCopyRequest,
-            ArchiveInst,
-            CalibrationGainFileInfo,
-            CorrAcqInfo,
-            CorrFileInfo,
-            DigitalGainFileInfo,
-            FileType,
-            FlagInputFileInfo,
-            HFBAcqInfo,
-            HFBFileInfo,
-            RawadcAcqInfo,
-            RawadcFileInfo,
-            StorageGroup,
-            StorageNode,
-            StorageTransferAction,
-            WeatherFileInfo,
-        ]
-    )
+    with proxy.atomic():
+        proxy.create_tables(
+            [
+                AcqFileTypes,
+                AcqType,
+                ArchiveAcq,
+                ArchiveFile,
+                ArchiveFileCopy,
+                ArchiveFileCopyRequest,
+                ArchiveInst,
+                CalibrationGainFileInfo,
+                CorrAcqInfo,
+                CorrFileInfo,
+                DigitalGainFileInfo,
+                FileType,
+                FlagInputFileInfo,
+                HFBAcqInfo,
+                HFBFileInfo,
+                RawadcAcqInfo,
+                RawadcFileInfo,
+                StorageGroup,
+                StorageNode,
+                StorageTransferAction,
+                WeatherFileInfo,
+            ]
+        )
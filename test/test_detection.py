@@ -0,0 +1,299 @@
+"""Test the import detection caches and file type matching."""
+
+import re
+import sys
+import logging
+import pytest
+from types import SimpleNamespace
+
+from alpenhorn_chime import detection, info
+
+from chimedb.data_index.orm import (
+    AcqFileTypes,
+    AcqType,
+    ArchiveAcq,
+    ArchiveFile,
+    ArchiveInst,
+    FileType,
+)
+
+# An acquisition name using the type and instrument created by the tests
+ACQ_NAME = "20230101T000000Z_testinst_testtype"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replace the detection clock with one controlled by the test.
+
+    Yields a one-element list holding the current time.  The caches
+    are cleared before and after the test."""
+
+    now = [1000.0]
+    monkeypatch.setattr(detection, "monotonic", lambda: now[0])
+    detection.clear_caches()
+    yield now
+    detection.clear_caches()
+
+
+@pytest.fixture
+def rollback(proxy, tables):
+    """Discard all database changes made during the test."""
+
+    with proxy.atomic() as txn:
+        yield
+        txn.rollback()
+
+
+def test_clear_caches(clock, rollback):
+    """clear_caches() makes the next lookup re-read the database."""
+
+    acqtype = AcqType.create(name="testtype")
+    ArchiveInst.create(name="testinst")
+
+    assert detection.parse_acq(ACQ_NAME).acqtype.name == "testtype"
+
+    # Still cached after the row is deleted
+    AcqType.delete().where(AcqType.id == acqtype.id).execute()
+    assert detection.parse_acq(ACQ_NAME) is not None
+
+    detection.clear_caches()
+    assert detection.parse_acq(ACQ_NAME) is None
+
+
+def test_cache_expiry(clock, rollback):
+    """The caches are re-read after they expire."""
+
+    ArchiveInst.create(name="testinst")
+    acqtype = AcqType.create(name="testtype")
+
+    assert detection.parse_acq(ACQ_NAME) is not None
+    AcqType.delete().where(AcqType.id == acqtype.id).execute()
+
+    clock[0] += detection._CACHE_LIFETIME - 1
+    assert detection.parse_acq(ACQ_NAME) is not None
+
+    clock[0] += 1
+    assert detection.parse_acq(ACQ_NAME) is None
+
+
+def test_reload_on_miss(clock, rollback):
+    """A failed lookup re-reads the caches, but not too often."""
+
+    ArchiveInst.create(name="testinst")
+
+    assert detection.parse_acq(ACQ_NAME) is None
+
+    # A type added right after the caches were loaded isn't seen yet...
+    AcqType.create(name="testtype")
+    assert detection.parse_acq(ACQ_NAME) is None
+
+    # ...but it is once the rate limit has passed, long before expiry
+    clock[0] += detection._MISS_RELOAD_INTERVAL
+    assert detection.parse_acq(ACQ_NAME).acqtype.name == "testtype"
+
+    # The same goes for a new instrument
+    ArchiveInst.create(name="newinst")
+    assert detection.parse_acq("20230101T000000Z_newinst_testtype") is None
+    clock[0] += detection._MISS_RELOAD_INTERVAL
+    assert detection.parse_acq("20230101T000000Z_newinst_testtype") is not None
+
+
+def test_bad_pattern(clock, rollback, caplog, monkeypatch):
+    """A malformed FileType pattern only disables that FileType."""
+
+    monkeypatch.setattr(detection, "_bad_patterns", set())
+
+    acqtype = AcqType.create(name="testtype")
+    ArchiveInst.create(name="testinst")
+    bad = FileType.create(name="bad", pattern=r"(unclosed")
+    good = FileType.create(name="good", pattern=r"\d+\.h5")
+    AcqFileTypes.create(acq_type=acqtype, file_type=bad)
+    AcqFileTypes.create(acq_type=acqtype, file_type=good)
+
+    acq_data = detection.parse_acq(ACQ_NAME)
+    assert acq_data is not None
+
+    filetype, _ = detection._match_filetype(acq_data.acqtype, "0001.h5")
+    assert filetype.name == "good"
+
+    # The bad pattern is reported as an error only once
+    detection.clear_caches()
+    assert detection.parse_acq(ACQ_NAME) is not None
+    errors = [record for record in caplog.records if record.levelno == logging.ERROR]
+    assert len(errors) == 1
+    assert "bad" in errors[0].getMessage()
+
+
+def test_store_info_failure(monkeypatch, rollback):
+    """A failing info class doesn't lose the acq or file type."""
+
+    def broken(**kwargs):
+        raise OSError("unreadable file")
+
+    monkeypatch.setitem(info.INFO_CLASSES, "broken", (False, broken))
+
+    acqtype = AcqType.create(name="testtype", info_class="broken")
+    inst = ArchiveInst.create(name="testinst")
+    filetype = FileType.create(name="testfile", info_class="broken")
+    acq = ArchiveAcq.create(name=ACQ_NAME)
+    file = ArchiveFile.create(name="0001.h5", acq=acq)
+
+    import_data = {
+        "acqtime": None,
+        "acqinst": inst,
+        "acqtype": acqtype,
+        "filetype": filetype,
+        "name_data": dict(),
+    }
+    copy = SimpleNamespace(file=SimpleNamespace(path=f"{ACQ_NAME}/0001.h5"))
+
+    # Both the acq and the file are updated, even though both infos fail
+    with pytest.raises(OSError):
+        detection.store_info(copy, file, acq, None, import_data=import_data)
+    updated = ArchiveAcq.get(id=acq.id)
+    assert updated.type_id == acqtype.id
+    assert updated.inst_id == inst.id
+    assert ArchiveFile.get(id=file.id).type_id == filetype.id
+
+    # The same goes for a file on its own
+    file = ArchiveFile.create(name="0002.h5", acq=acq)
+    with pytest.raises(OSError):
+        detection.store_info(copy, file, None, None, import_data=import_data)
+    assert ArchiveFile.get(id=file.id).type_id == filetype.id
+
+
+def test_store_info_acq_failure(monkeypatch, rollback):
+    """A failing acq info class doesn't stop the file info being stored."""
+
+    def broken(**kwargs):
+        raise OSError("unreadable file")
+
+    stored = list()
+
+    def working(item_, **kwargs):
+        stored.append(item_.id)
+        return SimpleNamespace(save=lambda: None)
+
+    monkeypatch.setitem(info.INFO_CLASSES, "broken", (False, broken))
+    monkeypatch.setitem(info.INFO_CLASSES, "working", (False, working))
+
+    acqtype = AcqType.create(name="testtype", info_class="broken")
+    inst = ArchiveInst.create(name="testinst")
+    filetype = FileType.create(name="testfile", info_class="working")
+    acq = ArchiveAcq.create(name=ACQ_NAME)
+    file = ArchiveFile.create(name="0001.h5", acq=acq)
+
+    import_data = {
+        "acqtime": None,
+        "acqinst": inst,
+        "acqtype": acqtype,
+        "filetype": filetype,
+        "name_data": dict(),
+    }
+    copy = SimpleNamespace(file=SimpleNamespace(path=f"{ACQ_NAME}/0001.h5"))
+
+    with pytest.raises(OSError):
+        detection.store_info(copy, file, acq, None, import_data=import_data)
+    assert ArchiveAcq.get(id=acq.id).type_id == acqtype.id
+    assert ArchiveFile.get(id=file.id).type_id == filetype.id
+    assert stored == [file.id]
+
+
+def _check_match(monkeypatch, patterns, names, combinable=True):
+    """Check that _match_filetype agrees with matching `patterns` in turn.
+
+    The file types are stood in for by the indices of their patterns."""
+
+    compiled = [re.compile(pattern) for pattern in patterns]
+    combined = detection._combine_patterns(compiled)
+    assert (combined is not None) == combinable
+
+    filetypes = [(pattern, index) for index, pattern in enumerate(compiled)]
+    monkeypatch.setattr(detection, "_filetype_cache", {1: (combined, filetypes)})
+    acqtype = SimpleNamespace(id=1)
+
+    for name in names:
+        expected = None
+        for index, pattern in enumerate(compiled):
+            m = pattern.match(name)
+            if m is not None:
+                expected = (index, m.groupdict())
+                break
+
+        assert detection._match_filetype(acqtype, name) == expected
+
+
+def test_match_named_groups(monkeypatch):
+    """Named groups shared between patterns are kept apart."""
+
+    _check_match(
+        monkeypatch,
+        [
+            r"(?P<num>\d+)_(?P<part>\d+)\.h5",
+            r"(?P<num>\d+)\.h5",
+            r"(?P<part>[a-z]+)\.(?P<num>\d)(?P<tail>x)?",
+        ],
+        ["0001_0002.h5", "0001.h5", "abc.5", "abc.5x", "xyz.h5", ""],
+    )
+
+
+def test_match_backrefs(monkeypatch):
+    """Named backreferences and conditionals are renamed, too."""
+
+    _check_match(
+        monkeypatch,
+        [
+            r"(?P<a>x)?y(?(a)z|w)\Z",
+            r"(?P<q>['\"])\w+(?P=q)\.h5",
+            r"(?P<a>\w)(?P=a)",
+        ],
+        ["xyz", "yw", "xyw", "'abc'.h5", "'abc\".h5", '"abc".h5', "qq", "qr"],
+    )
+
+
+@pytest.mark.parametrize(
+    "uncombinable",
+    [
+        r"(?i)abc\.h5",
+        pytest.param(
+            r"\d+(?i)\.H5",
+            marks=pytest.mark.skipif(
+                sys.version_info >= (3, 11),
+                reason="mid-pattern global flags are an error in Python >= 3.11",
+            ),
+        ),
+        r"(\d)\1\.h5",
+        r"(a)?b(?(1)c|d)",
+    ],
+)
+@pytest.mark.filterwarnings("ignore:Flags not at the start:DeprecationWarning")
+def test_match_uncombinable(monkeypatch, uncombinable):
+    """Global flags and numbered references fall back to matching in turn."""
+
+    _check_match(
+        monkeypatch,
+        [r"(?P<num>\d+)_x\.h5", uncombinable, r"\d+\.h5"],
+        [
+            "12_x.h5",
+            "12_X.h5",
+            "ABC.h5",
+            "abc.h5",
+            "11.h5",
+            "12.h5",
+            "12.H5",
+            "bd",
+            "abc",
+            "x",
+        ],
+        combinable=False,
+    )
+
+
+def test_match_first(monkeypatch):
+    """When several patterns match, the first one wins."""
+
+    _check_match(
+        monkeypatch,
+        [r"\d+\.h5", r"(?P<num>\d+)\.h5", r"(?P<any>.*)"],
+        ["1.h5", "x.h5", ""],
+    )
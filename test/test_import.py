@@ -2,13 +2,13 @@
 
 import pytest
 
+import os
 import shutil
-import pathlib
-import tempfile
 import subprocess
 from time import sleep
 from signal import SIGINT
-from unittest.mock import patch
+
+import peewee as pw
 
 from chimedb.data_index import util
 
@@ -30,35 +30,55 @@ from chimedb.data_index.orm import (
     FileType,
 )
 
-
-@pytest.fixture
-def testdata():
-    """Yields the path to the testdata directory."""
-
-    return str(pathlib.Path(__file__).with_name("testdata"))
-
-
-@pytest.fixture
-def tempdb():
-    """Create the test database.
-
-    Yields the path to the database.
-
-    The database is deleted after the test completes."""
-
-    with tempfile.NamedTemporaryFile(suffix=".sql") as sqldb:
-        yield sqldb.name
-
-
-@pytest.fixture
+# The acquisitions in the test data
+GAIN_ACQ = "20201101T000000Z_chime_gain"
+DIGITALGAIN_ACQ = "20210321T121000Z_chime_digitalgain"
+RAWADC_ACQ = "20230213T201433Z_chime_rawadc"
+FLAGINPUT_ACQ = "20220101T000000Z_chime_flaginput"
+WEATHER_ACQ = "20221101T000000Z_chime_weather"
+CORR_ACQ = "20220129T233553Z_chimetiming_corr"
+
+# The files in the test data
+RAWADC_FILE = "000003.h5"
+FLAGINPUT_FILE = "00947042.h5"
+WEATHER_FILE = "20221106.h5"
+GAIN_FILE = "00358972.h5"
+DIGITALGAIN_FILE = "00001101.h5"
+CORR_FILE = "00000000_0000.h5"
+
+# The expected instrument and type of each acq
+ACQ_DATA = [
+    (GAIN_ACQ, "chime", "gain"),
+    (DIGITALGAIN_ACQ, "chime", "digitalgain"),
+    (RAWADC_ACQ, "chime", "rawadc"),
+    (FLAGINPUT_ACQ, "chime", "flaginput"),
+    (WEATHER_ACQ, "chime", "weather"),
+    (CORR_ACQ, "chimetiming", "corr"),
+]
+
+# The expected acq and type of each file
+FILE_DATA = [
+    (RAWADC_FILE, RAWADC_ACQ, "rawadc"),
+    (FLAGINPUT_FILE, FLAGINPUT_ACQ, "calibration"),
+    (WEATHER_FILE, WEATHER_ACQ, "weather"),
+    (GAIN_FILE, GAIN_ACQ, "calibration"),
+    (DIGITALGAIN_FILE, DIGITALGAIN_ACQ, "calibration"),
+    (CORR_FILE, CORR_ACQ, "corr"),
+]
+
+
+@pytest.fixture(scope="session")
 def chime_data(tables):
-    """Ensure the CHIME data has been added to the database."""
+    """Ensure the CHIME data has been added to the database.
+
+    The types and instruments don't change between tests, so this
+    only needs to be done once per session."""
 
     util.update_types()
     util.update_inst()
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def test_data(proxy, tables, testdata):
     """Set db data for the test."""
 
@@ -75,150 +95,174 @@ def test_data(proxy, tables, testdata):
     )
 
 
-@pytest.fixture
-def set_env(testdata, tempdb):
-    """Set up the environment for the test."""
+@pytest.fixture(scope="session")
+def alpenhornd():
+    """Yields the path to the alpenhornd executable.
 
-    # We set both CHIMEDB vars, because while the test itself runs in test-safe mode,
-    # alpenhorn itself won't be doing that.
-    with patch.dict(
-        "os.environ",
-        ALPENHORN_CONFIG_FILE=str(pathlib.Path(testdata, "alpenhorn.yaml")),
-        CHIMEDB_SQLITE=tempdb,
-        CHIMEDB_TEST_SQLITE=tempdb,
-    ):
-        yield
+    Looked up on the PATH once per test session."""
 
+    path = shutil.which("alpenhornd")
+    assert path is not None
+    return path
 
-def test_import(tempdb, set_env, tables, chime_data, test_data):
-    """Test import of CHIME files."""
 
-    alpenhornd = shutil.which("alpenhornd")
-    assert alpenhornd is not None
+@pytest.fixture(scope="session")
+def imported(alpenhornd, set_env, tables, chime_data, test_data):
+    """Run alpenhornd on the test data.
+
+    This happens once per session.  Yields a dict of the ids of the
+    imported acqs and files, keyed by name."""
 
-    # Start alpenhorn server in a subprocess
-    alp = subprocess.Popen([alpenhornd])
+    # Start alpenhorn server in a subprocess.  Its output is discarded
+    # unless ALPENHORN_TEST_VERBOSE is set.
+    output = None if os.environ.get("ALPENHORN_TEST_VERBOSE") else subprocess.DEVNULL
+    alp = subprocess.Popen([alpenhornd], stdout=output, stderr=output)
 
     # Wait at most ten seconds
-    for x in range(10):
+    for x in range(100):
         # Check for abnormal termination
         assert not alp.poll()
 
-        # Wait until six files have been registered
-        if ArchiveFileCopy.select().count() == 6:
+        # Wait until six files have been registered.  We only need to know
+        # whether there are six file copies, so fetch at most six ids
+        # rather than counting the whole table.
+        if len(ArchiveFileCopy.select(ArchiveFileCopy.id).limit(6).tuples()) == 6:
             break
 
         # Wait and try again
-        sleep(1)
+        sleep(0.1)
 
     # Terminate alpenhornd via keyboard interrupt
     alp.send_signal(SIGINT)
 
-    # Wait for termination
-    alp.wait()
+    # Wait for termination, but don't let a hung daemon hang the tests
+    try:
+        alp.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        alp.kill()
+        alp.wait()
+        raise
+
+    ids = dict(ArchiveAcq.select(ArchiveAcq.name, ArchiveAcq.id).tuples())
+    ids.update(ArchiveFile.select(ArchiveFile.name, ArchiveFile.id).tuples())
+    return ids
+
+
+# The info tables to check.  Each should have exactly one row, for the
+# named acq or file, with the given contents.
+INFO_DATA = [
+    (
+        DigitalGainFileInfo,
+        "file",
+        DIGITALGAIN_FILE,
+        {"start_time": 1616329701.187867, "finish_time": 1616329701.187867},
+    ),
+    (
+        CalibrationGainFileInfo,
+        "file",
+        GAIN_FILE,
+        {"start_time": 1604547772.630382, "finish_time": 1604547796.087183},
+    ),
+    (
+        FlagInputFileInfo,
+        "file",
+        FLAGINPUT_FILE,
+        {"start_time": 1641942242.17755, "finish_time": 1641945009.510767},
+    ),
+    (
+        WeatherFileInfo,
+        "file",
+        WEATHER_FILE,
+        {
+            "date": "20221106",
+            "start_time": 1667692800.0,
+            "finish_time": 1667779199.0,
+        },
+    ),
+    (
+        CorrFileInfo,
+        "file",
+        CORR_FILE,
+        {
+            "chunk_number": 0,
+            "freq_number": 0,
+            "start_time": 1643499353.1176474,
+            "finish_time": 1643499353.1176474,
+        },
+    ),
+    (
+        RawadcFileInfo,
+        "file",
+        RAWADC_FILE,
+        {"start_time": 1676325138.068710, "finish_time": 1676325566.065336},
+    ),
+    (
+        CorrAcqInfo,
+        "acq",
+        CORR_ACQ,
+        {"nfreq": 1024, "nprod": 120, "integration": None},
+    ),
+    (RawadcAcqInfo, "acq", RAWADC_ACQ, {"start_time": 1676319273.0}),
+]
+
+
+def test_import(imported):
+    """Test import of CHIME files."""
 
-    # Check
-    chime_inst = ArchiveInst.get(name="chime")
-    chimetiming_inst = ArchiveInst.get(name="chimetiming")
-    ids = dict()
+    # Check.  Everything below is compared by id, so rows are fetched
+    # as tuples, rather than as model instances.
+    inst_ids = dict(
+        ArchiveInst.select(ArchiveInst.name, ArchiveInst.id)
+        .where(ArchiveInst.name.in_({inst for _, inst, _ in ACQ_DATA}))
+        .tuples()
+    )
+    acq_types = dict(
+        AcqType.select(AcqType.name, AcqType.id)
+        .where(AcqType.name.in_({type_ for _, _, type_ in ACQ_DATA}))
+        .tuples()
+    )
+    file_types = dict(
+        FileType.select(FileType.name, FileType.id)
+        .where(FileType.name.in_({type_ for _, _, type_ in FILE_DATA}))
+        .tuples()
+    )
 
     acq_data = {
-        "20201101T000000Z_chime_gain": (chime_inst, AcqType.get(name="gain")),
-        "20210321T121000Z_chime_digitalgain": (
-            chime_inst,
-            AcqType.get(name="digitalgain"),
-        ),
-        "20230213T201433Z_chime_rawadc": (chime_inst, AcqType.get(name="rawadc")),
-        "20220101T000000Z_chime_flaginput": (chime_inst, AcqType.get(name="flaginput")),
-        "20221101T000000Z_chime_weather": (chime_inst, AcqType.get(name="weather")),
-        "20220129T233553Z_chimetiming_corr": (
-            chimetiming_inst,
-            AcqType.get(name="corr"),
-        ),
+        name: (inst_ids[inst], acq_types[type_]) for name, inst, type_ in ACQ_DATA
     }
-    for acq in ArchiveAcq.select():
-        assert acq.inst == acq_data[acq.name][0]
-        assert acq.type == acq_data[acq.name][1]
-
-        # Remember for later
-        ids[acq.name] = acq.id
-
-    file_data = {
-        "000003.h5": ("20230213T201433Z_chime_rawadc", FileType.get(name="rawadc")),
-        "00947042.h5": (
-            "20220101T000000Z_chime_flaginput",
-            FileType.get(name="calibration"),
-        ),
-        "20221106.h5": ("20221101T000000Z_chime_weather", FileType.get(name="weather")),
-        "00358972.h5": (
-            "20201101T000000Z_chime_gain",
-            FileType.get(name="calibration"),
-        ),
-        "00001101.h5": (
-            "20210321T121000Z_chime_digitalgain",
-            FileType.get(name="calibration"),
-        ),
-        "00000000_0000.h5": (
-            "20220129T233553Z_chimetiming_corr",
-            FileType.get(name="corr"),
-        ),
+    for name, inst_id, type_id in ArchiveAcq.select(
+        ArchiveAcq.name, ArchiveAcq.inst, ArchiveAcq.type
+    ).tuples():
+        assert inst_id == acq_data[name][0]
+        assert type_id == acq_data[name][1]
+
+    file_data = {name: (acq, file_types[type_]) for name, acq, type_ in FILE_DATA}
+    for name, acq_id, type_id in ArchiveFile.select(
+        ArchiveFile.name, ArchiveFile.acq, ArchiveFile.type
+    ).tuples():
+        assert acq_id == imported[file_data[name][0]]
+        assert type_id == file_data[name][1]
+
+    # Each info table should have exactly one row.  Count them all in a
+    # single UNION ALL query.
+    counts = None
+    for model, *_ in INFO_DATA:
+        query = model.select(pw.Value(model.__name__), pw.fn.COUNT(model.id))
+        counts = query if counts is None else counts + query
+    assert dict(counts.tuples()) == {model.__name__: 1 for model, *_ in INFO_DATA}
+
+
+@pytest.mark.parametrize(
+    "info_class, key, name, expected",
+    INFO_DATA,
+    ids=[info_class.__name__ for info_class, *_ in INFO_DATA],
+)
+def test_info(imported, info_class, key, name, expected):
+    """Test the contents of the info tables."""
+
+    # Fetch the row as a plain dict of the columns being checked
+    columns = [getattr(info_class, column) for column in [key, *expected]]
+    assert info_class.select(*columns).dicts().get() == {
+        key: imported[name],
+        **expected,
     }
-
-    for file in ArchiveFile.select():
-        assert file.acq_id == ids[file_data[file.name][0]]
-        assert file.type == file_data[file.name][1]
-
-        # Remember for later
-        ids[file.name] = file.id
-
-    # Now check all the info tables.
-    assert DigitalGainFileInfo.select().count() == 1
-    for info in DigitalGainFileInfo.select():
-        assert info.file.id == ids["00001101.h5"]
-        assert info.start_time == 1616329701.187867
-        assert info.finish_time == 1616329701.187867
-
-    assert CalibrationGainFileInfo.select().count() == 1
-    for info in CalibrationGainFileInfo.select():
-        assert info.file.id == ids["00358972.h5"]
-        assert info.start_time == 1604547772.630382
-        assert info.finish_time == 1604547796.087183
-
-    assert FlagInputFileInfo.select().count() == 1
-    for info in FlagInputFileInfo.select():
-        assert info.file.id == ids["00947042.h5"]
-        assert info.start_time == 1641942242.17755
-        assert info.finish_time == 1641945009.510767
-
-    assert WeatherFileInfo.select().count() == 1
-    for info in WeatherFileInfo.select():
-        assert info.file.id == ids["20221106.h5"]
-        assert info.date == "20221106"
-        assert info.start_time == 1667692800.0
-        assert info.finish_time == 1667779199.0
-
-    assert CorrFileInfo.select().count() == 1
-    for info in CorrFileInfo.select():
-        assert info.file.id == ids["00000000_0000.h5"]
-        assert info.chunk_number == 0
-        assert info.freq_number == 0
-        assert info.start_time == 1643499353.1176474
-        assert info.finish_time == 1643499353.1176474
-
-    assert RawadcFileInfo.select().count() == 1
-    for info in RawadcFileInfo.select():
-        assert info.file.id == ids["000003.h5"]
-        assert info.start_time == 1676325138.068710
-        assert info.finish_time == 1676325566.065336
-
-    assert CorrAcqInfo.select().count() == 1
-    for info in CorrAcqInfo.select():
-        assert info.acq.id == ids["20220129T233553Z_chimetiming_corr"]
-        assert info.nfreq == 1024
-        assert info.nprod == 120
-        assert info.integration is None
-
-    assert RawadcAcqInfo.select().count() == 1
-    for info in RawadcAcqInfo.select():
-        assert info.acq.id == ids["20230213T201433Z_chime_rawadc"]
-        assert info.start_time == 1676319273.0